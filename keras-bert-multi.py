@@ -1,3 +1,13 @@
+import os
+import functools
+import hashlib
+import itertools
+import math
+import operator
+import re
+import shutil
+import tempfile
+import multiprocessing
 import tensorflow as tf
 import pandas as pd
 import tensorflow_hub as hub
@@ -5,15 +15,12 @@ import numpy as np
 from bert.tokenization import FullTokenizer
 from tqdm import tqdm
 from tensorflow.keras import backend as K
+from tensorflow.core.protobuf import rewriter_config_pb2
 from utils.log import logger
-from utils.df_utils import one_to_many, get_values
+from utils.df_utils import one_to_many
 import plac
 from pathlib import Path
 
-# Initialize session
-sess = tf.Session()
-
-
 class PaddingInputExample(object):
     """Fake example so the num input examples is a multiple of the batch size.
   When running eval/predict on the TPU, we need to pad the number of examples
@@ -49,79 +56,225 @@ MODEL_PATH = '/Users/nadjet/tmp/keras-bert'
 BERT_PATH = "https://tfhub.dev/google/bert_multi_cased_L-12_H-768_A-12/1"
 MAX_SEQ_LENGTH = 256
 NUM_CLASSES = 8
+BATCH_SIZE = 64
+FEATURES_CACHE_DIR = '/tmp/keras-bert-features'
+FEATURE_NAMES = ('input_ids', 'input_masks', 'segment_ids', 'labels')
+
+def _require_mixed_precision():
+    if "auto_mixed_precision" not in rewriter_config_pb2.RewriterConfig.DESCRIPTOR.fields_by_name or not hasattr(
+        getattr(tf.train, "experimental", None), "MixedPrecisionLossScaleOptimizer"
+    ):
+        raise RuntimeError(f"Mixed precision requires tensorflow>=1.14 (found {tf.__version__})")
+
+
+def _require_tflite():
+    if not hasattr(getattr(tf, "lite", None), "RepresentativeDataset"):
+        raise RuntimeError(f"Quantization requires tensorflow>=1.14 (found {tf.__version__})")
+
+
+def create_session(xla=False, mixed_precision=False):
+    """Session with one intra-op thread per core and, if `xla` is set, XLA JIT
+    (the input shapes are static). If `mixed_precision` is set, the session's
+    graph rewriter casts eligible ops (the BERT matmuls) to float16. Created in
+    `main` rather than at import time.
+    """
+    config = tf.ConfigProto()
+    if xla:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    if mixed_precision:
+        _require_mixed_precision()
+        config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+    config.gpu_options.allow_growth = True
+    config.intra_op_parallelism_threads = os.cpu_count() or 1
+    config.inter_op_parallelism_threads = 2
+    return tf.Session(config=config)
+
+
+def get_tokenization_info(bert_path):
+    """Get the vocab file and casing info from the Hub module.
+    The module is loaded in a throwaway graph, so the training graph only
+    holds the one `BertLayer` module.
+    """
+    with tf.Graph().as_default(), tf.Session() as sess:
+        bert_module = hub.Module(bert_path)
+        tokenization_info = bert_module(signature="tokenization_info", as_dict=True)
+        vocab_file, do_lower_case = sess.run(
+            [tokenization_info["vocab_file"], tokenization_info["do_lower_case"]]
+        )
+    return vocab_file.decode("utf-8"), bool(do_lower_case)
 
-def create_tokenizer_from_hub_module(bert_path):
-    """Get the vocab file and casing info from the Hub module."""
-    bert_module = hub.Module(bert_path)
-    tokenization_info = bert_module(signature="tokenization_info", as_dict=True)
-    vocab_file, do_lower_case = sess.run(
-        [tokenization_info["vocab_file"], tokenization_info["do_lower_case"]]
-    )
 
-    return FullTokenizer(vocab_file=vocab_file, do_lower_case=do_lower_case)
+def create_tokenizer(vocab_file, do_lower_case, fast_tokenizer=False, gpu_tokenizer=False):
+    """Python `FullTokenizer` over `vocab_file`.
+    If `fast_tokenizer` is set, a Rust `tokenizers.BertWordPieceTokenizer`
+    over the same vocab is returned instead; if `gpu_tokenizer` is set, a
+    RAPIDS `cudf` `SubwordTokenizer`.
+    """
+    if gpu_tokenizer:
+        from cudf.core.subword_tokenizer import SubwordTokenizer
+        from cudf.utils.hash_vocab_utils import hash_vocab
+        hash_file = vocab_file + ".hash"
+        if not os.path.exists(hash_file):
+            # Hashed to a temporary file first, so an interrupted run leaves no truncated hash file
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(hash_file), prefix=os.path.basename(hash_file) + ".")
+            os.close(fd)
+            try:
+                hash_vocab(vocab_file, tmp_file)
+                os.replace(tmp_file, hash_file)
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+        return SubwordTokenizer(hash_file, do_lower_case=do_lower_case)
+    if fast_tokenizer:
+        from tokenizers import BertWordPieceTokenizer
+        return BertWordPieceTokenizer(vocab_file, lowercase=do_lower_case)
+    tokenizer = FullTokenizer(vocab_file=vocab_file, do_lower_case=do_lower_case)
+    # Plain dict copy of the vocab for `convert_single_example`
+    tokenizer._fast_vocab = dict(tokenizer.vocab)
+    return tokenizer
 
 
 def convert_single_example(tokenizer, example, max_seq_length=MAX_SEQ_LENGTH):
-    """Converts a single `InputExample` into a single `InputFeatures`."""
+    """Converts a single `InputExample` into its (unpadded) token ids and label.
+    Padding, the input mask and the (all-zero) segment ids are left to the
+    caller, which writes `input_ids` into a zero-filled matrix.
+    """
 
     if isinstance(example, PaddingInputExample):
-        input_ids = [0] * max_seq_length
-        input_mask = [0] * max_seq_length
-        segment_ids = [0] * max_seq_length
-        label = [0] * NUM_CLASSES
-        return input_ids, input_mask, segment_ids, label
-
-    tokens_a = tokenizer.tokenize(example.text_a)
-    if len(tokens_a) > max_seq_length - 2:
-        tokens_a = tokens_a[0 : (max_seq_length - 2)]
-
-    tokens = []
-    segment_ids = []
-    tokens.append("[CLS]")
-    segment_ids.append(0)
-    for token in tokens_a:
-        tokens.append(token)
-        segment_ids.append(0)
-    tokens.append("[SEP]")
-    segment_ids.append(0)
-
-    input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-    # The mask has 1 for real tokens and 0 for padding tokens. Only real
-    # tokens are attended to.
-    input_mask = [1] * len(input_ids)
-
-    # Zero-pad up to the sequence length.
-    while len(input_ids) < max_seq_length:
-        input_ids.append(0)
-        input_mask.append(0)
-        segment_ids.append(0)
-
-    assert len(input_ids) == max_seq_length
-    assert len(input_mask) == max_seq_length
-    assert len(segment_ids) == max_seq_length
-
-    return input_ids, input_mask, segment_ids, example.label
-
-
-def convert_examples_to_features(tokenizer, examples, max_seq_length=MAX_SEQ_LENGTH):
-    """Convert a set of `InputExample`s to a list of `InputFeatures`."""
-
-    input_ids, input_masks, segment_ids, labels = [], [], [], []
-    for example in tqdm(examples, desc="Converting examples to features"):
-        input_id, input_mask, segment_id, label = convert_single_example(
-            tokenizer, example, max_seq_length
-        )
-        input_ids.append(input_id)
-        input_masks.append(input_mask)
-        segment_ids.append(segment_id)
-        labels.append(label)
-    return (
-        np.array(input_ids),
-        np.array(input_masks),
-        np.array(segment_ids),
-        np.array(labels)
+        return [], [0] * NUM_CLASSES
+
+    # Same as `tokenizer.tokenize`, but stops as soon as max_seq_length - 2 subtokens
+    # are reached. Every basic token yields at least one subtoken.
+    max_tokens = max_seq_length - 2
+    tokens_a = []
+    for token in tokenizer.basic_tokenizer.tokenize(example.text_a)[0:max_tokens]:
+        tokens_a.extend(tokenizer.wordpiece_tokenizer.tokenize(token))
+        if len(tokens_a) >= max_tokens:
+            tokens_a = tokens_a[0:max_tokens]
+            break
+
+    tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
+
+    # `tokens` always holds at least [CLS] and [SEP], so itemgetter returns a tuple
+    input_ids = list(operator.itemgetter(*tokens)(tokenizer._fast_vocab))
+
+    assert len(input_ids) <= max_seq_length
+
+    return input_ids, example.label
+
+
+# Tokenizer of the current worker process, set by `_init_worker`
+_worker_tokenizer = None
+
+
+def _init_worker(vocab_file, do_lower_case):
+    """Build one tokenizer per worker process, kept for the lifetime of the pool."""
+    global _worker_tokenizer
+    _worker_tokenizer = create_tokenizer(vocab_file, do_lower_case)
+
+
+def _tok_worker(args):
+    example, max_seq_length = args
+    return convert_single_example(_worker_tokenizer, example, max_seq_length)
+
+
+def create_tokenizer_pool(vocab_file, do_lower_case, num_workers=None):
+    """Pool of `num_workers` (one per core by default) tokenizer processes, for
+    `convert_examples_to_features`. The caller closes it once all sets are converted.
+    """
+    # Spawned rather than forked: the parent already runs TensorFlow threads
+    return multiprocessing.get_context("spawn").Pool(
+        num_workers or os.cpu_count() or 1, initializer=_init_worker, initargs=(vocab_file, do_lower_case)
+    )
+
+
+def convert_examples_to_features(vocab_file, do_lower_case, examples, max_seq_length=MAX_SEQ_LENGTH, pool=None):
+    """Convert a set of `InputExample`s to a list of `InputFeatures`.
+    Tokenization runs in `pool` (see `create_tokenizer_pool`) if given, otherwise
+    in this process.
+    """
+
+    n = len(examples)
+    input_ids = np.zeros((n, max_seq_length), dtype=np.int32)
+    input_masks = np.zeros((n, max_seq_length), dtype=np.uint8)
+    # No second sequence, so segment ids stay all zeros
+    segment_ids = np.zeros_like(input_ids)
+    labels = np.zeros((n, NUM_CLASSES), dtype=np.int8)
+    if pool is not None:
+        features = pool.imap(_tok_worker, zip(examples, itertools.repeat(max_seq_length)), chunksize=256)
+    else:
+        tokenizer = create_tokenizer(vocab_file, do_lower_case)
+        features = (convert_single_example(tokenizer, example, max_seq_length) for example in examples)
+    for i, (input_id, label) in enumerate(
+        tqdm(features, total=n, desc="Converting examples to features")
+    ):
+        # The mask has 1 for real tokens and 0 for padding tokens. Only real
+        # tokens are attended to.
+        real_len = len(input_id)
+        input_ids[i, :real_len] = input_id
+        input_masks[i, :real_len] = 1
+        labels[i] = label
+    return input_ids, input_masks, segment_ids, labels
+
+
+def _stack_labels(examples):
+    """(n, NUM_CLASSES) int8 label matrix, all zeros for padding examples."""
+    labels = np.zeros((len(examples), NUM_CLASSES), dtype=np.int8)
+    for i, example in enumerate(examples):
+        if not isinstance(example, PaddingInputExample):
+            labels[i] = example.label
+    return labels
+
+
+def _stack_encodings(encodings, attribute, dtype, max_seq_length):
+    """Read one (padded) attribute of every `Encoding` into an (n, max_seq_length) matrix in a single pass."""
+    values = itertools.chain.from_iterable(getattr(encoding, attribute) for encoding in encodings)
+    return np.fromiter(values, dtype=dtype, count=len(encodings) * max_seq_length).reshape(
+        len(encodings), max_seq_length
+    )
+
+
+def convert_examples_to_features_fast(tokenizer, examples, max_seq_length=MAX_SEQ_LENGTH):
+    """Same as `convert_examples_to_features`, for a `BertWordPieceTokenizer`.
+    The whole set is encoded with a single (multithreaded) `encode_batch` call.
+    """
+
+    tokenizer.enable_truncation(max_length=max_seq_length)
+    tokenizer.enable_padding(length=max_seq_length)
+    is_padding = np.array([isinstance(example, PaddingInputExample) for example in examples], dtype=bool)
+    encodings = tokenizer.encode_batch(
+        ["" if padding else example.text_a for example, padding in zip(examples, is_padding)]
+    )
+    input_ids = _stack_encodings(encodings, "ids", np.int32, max_seq_length)
+    input_masks = _stack_encodings(encodings, "attention_mask", np.uint8, max_seq_length)
+    segment_ids = _stack_encodings(encodings, "type_ids", np.int32, max_seq_length)
+    input_ids[is_padding] = 0
+    input_masks[is_padding] = 0
+    return input_ids, input_masks, segment_ids, _stack_labels(examples)
+
+
+def convert_examples_to_features_gpu(tokenizer, examples, max_seq_length=MAX_SEQ_LENGTH):
+    """Same as `convert_examples_to_features`, for a `cudf` `SubwordTokenizer`.
+    The WordPiece tokenization of the whole set runs on the GPU.
+    """
+    import cudf
+
+    is_padding = np.array([isinstance(example, PaddingInputExample) for example in examples], dtype=bool)
+    texts = cudf.Series(["" if padding else example.text_a for example, padding in zip(examples, is_padding)])
+    output = tokenizer(
+        texts,
+        max_length=max_seq_length,
+        max_num_rows=len(texts),
+        padding="max_length",
+        truncation=True,
+        return_tensors="cp",
     )
+    input_ids = output["input_ids"].astype("int32").get()
+    input_masks = output["attention_mask"].astype("uint8").get()
+    segment_ids = np.zeros_like(input_ids)
+    input_ids[is_padding] = 0
+    input_masks[is_padding] = 0
+    return input_ids, input_masks, segment_ids, _stack_labels(examples)
 
 
 def convert_text_to_examples(texts, labels):
@@ -135,6 +288,12 @@ def convert_text_to_examples(texts, labels):
 
 
 class BertLayer(tf.keras.layers.Layer):
+    # Graph collection of the hub modules already loaded, as (bert_path, trainable, module),
+    # so that rebuilding the layer (e.g. in `load_model`) does not load BERT a second time.
+    # A module can only be called in its own graph, and being stored on the graph, it is
+    # freed with it: a new graph (e.g. after `K.clear_session()`) loads it again.
+    _MODULE_COLLECTION = "bert_layer_hub_modules"
+
     def __init__(
         self,
         n_fine_tune_layers=10,
@@ -155,9 +314,19 @@ class BertLayer(tf.keras.layers.Layer):
         super(BertLayer, self).__init__(**kwargs)
 
     def build(self, input_shape):
-        self.bert = hub.Module(
-            self.bert_path, trainable=self.trainable, name=f"{self.name}_module"
-        )
+        graph = tf.get_default_graph()
+        cached = [
+            module
+            for bert_path, trainable, module in graph.get_collection(BertLayer._MODULE_COLLECTION)
+            if bert_path == self.bert_path and trainable == self.trainable
+        ]
+        if cached:
+            self.bert = cached[0]
+        else:
+            self.bert = hub.Module(
+                self.bert_path, trainable=self.trainable, name=f"{self.name}_module"
+            )
+            graph.add_to_collection(BertLayer._MODULE_COLLECTION, (self.bert_path, self.trainable, self.bert))
 
         # Remove unused layers
         trainable_vars = self.bert.variables
@@ -182,27 +351,28 @@ class BertLayer(tf.keras.layers.Layer):
             trainable_layers.append(f"encoder/layer_{str(11 - i)}")
 
         # Update trainable vars to contain only the specified layers
-        trainable_vars = [
-            var
-            for var in trainable_vars
-            if any([l in var.name for l in trainable_layers])
-        ]
+        # An empty pattern would match everything, while no layer means nothing to fine tune
+        if trainable_layers:
+            trainable_pattern = re.compile("|".join(re.escape(l) for l in trainable_layers))
+            trainable_vars = [var for var in trainable_vars if trainable_pattern.search(var.name)]
+        else:
+            trainable_vars = []
 
         # Add to trainable weights
         for var in trainable_vars:
             self._trainable_weights.append(var)
 
+        trainable_ids = {id(var) for var in self._trainable_weights}
         for var in self.bert.variables:
-            if var not in self._trainable_weights:
+            if id(var) not in trainable_ids:
                 self._non_trainable_weights.append(var)
 
         super(BertLayer, self).build(input_shape)
 
     def call(self, inputs):
-        inputs = [K.cast(x, dtype="int32") for x in inputs]
         input_ids, input_mask, segment_ids = inputs
         bert_inputs = dict(
-            input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids
+            input_ids=input_ids, input_mask=tf.cast(input_mask, tf.int32), segment_ids=segment_ids
         )
         if self.pooling == "first":
             pooled = self.bert(inputs=bert_inputs, signature="tokens", as_dict=True)[
@@ -212,17 +382,20 @@ class BertLayer(tf.keras.layers.Layer):
             result = self.bert(inputs=bert_inputs, signature="tokens", as_dict=True)[
                 "sequence_output"
             ]
-
-            mul_mask = lambda x, m: x * tf.expand_dims(m, axis=-1)
-            masked_reduce_mean = lambda x, m: tf.reduce_sum(mul_mask(x, m), axis=1) / (
-                    tf.reduce_sum(m, axis=1, keepdims=True) + 1e-10)
-            input_mask = tf.cast(input_mask, tf.float32)
-            pooled = masked_reduce_mean(result, input_mask)
+            pooled = self.masked_reduce_mean(result, input_mask)
         else:
             raise NameError(f"Undefined pooling type (must be either first or mean, but is {self.pooling}")
 
         return pooled
 
+    @staticmethod
+    def masked_reduce_mean(x, mask):
+        """Mean of `x` over the sequence axis, counting only unmasked tokens."""
+        mask_f = tf.cast(mask, x.dtype)
+        # Masked sum over the sequence as one einsum (a batched matmul of x with the mask)
+        summed = tf.einsum("bld,bl->bd", x, mask_f)
+        return summed / (tf.reduce_sum(mask_f, axis=1, keepdims=True) + 1e-10)
+
     def compute_output_shape(self, input_shape):
         return (input_shape[0], self.output_size)
 
@@ -236,10 +409,10 @@ class BertLayer(tf.keras.layers.Layer):
 
 
 # Build model
-def build_model(max_seq_length):
-    in_id = tf.keras.layers.Input(shape=(max_seq_length,), name="input_ids")
-    in_mask = tf.keras.layers.Input(shape=(max_seq_length,), name="input_masks")
-    in_segment = tf.keras.layers.Input(shape=(max_seq_length,), name="segment_ids")
+def build_model(max_seq_length, mixed_precision=False):
+    in_id = tf.keras.layers.Input(shape=(max_seq_length,), dtype="int32", name="input_ids")
+    in_mask = tf.keras.layers.Input(shape=(max_seq_length,), dtype="uint8", name="input_masks")
+    in_segment = tf.keras.layers.Input(shape=(max_seq_length,), dtype="int32", name="segment_ids")
     bert_inputs = [in_id, in_mask, in_segment]
 
     bert_output = BertLayer(n_fine_tune_layers=3)(bert_inputs)
@@ -247,7 +420,15 @@ def build_model(max_seq_length):
     pred = tf.keras.layers.Dense(NUM_CLASSES, activation="sigmoid")(dense)
 
     model = tf.keras.models.Model(inputs=bert_inputs, outputs=pred)
-    model.compile(loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
+    optimizer = "adam"
+    if mixed_precision:
+        # The float16 casts are done by the session (see `create_session`), this
+        # only adds dynamic loss scaling so small gradients do not underflow
+        _require_mixed_precision()
+        optimizer = tf.train.experimental.MixedPrecisionLossScaleOptimizer(
+            tf.train.AdamOptimizer(), loss_scale="dynamic"
+        )
+    model.compile(loss="categorical_crossentropy", optimizer=optimizer, metrics=["accuracy"])
     model.summary()
 
     return model
@@ -260,13 +441,171 @@ def initialize_vars(sess):
     K.set_session(sess)
 
 
-@plac.annotations(
-    csv_file=("Path to input csv file", "positional", None, Path),
-    text_column=("Name of text column","option","text_column",str),
-    label_column=("Name of label column", "option", "label_column", str),
-    bert_path=("Bert url", "option", "bert_path", str),
-)
-def main(csv_file, text_column='text', label_column='labels', bert_path=BERT_PATH, max_seq_length=MAX_SEQ_LENGTH, model_path=MODEL_PATH):
+def make_dataset(sess, input_ids, input_masks, segment_ids, labels, batch_size=BATCH_SIZE, shuffle=False):
+    """Batched and prefetched `tf.data` iterator over the features, keyed by model input name.
+    The arrays are fed once through placeholders when the iterator is initialized
+    in `sess`, rather than embedded in the graph as constants.
+    Returns the iterator with its number of steps per epoch.
+    """
+    arrays = (input_ids, input_masks, segment_ids, labels)
+    placeholders = [tf.placeholder(tf.as_dtype(array.dtype), array.shape) for array in arrays]
+    ids_placeholder, masks_placeholder, segments_placeholder, labels_placeholder = placeholders
+    dataset = tf.data.Dataset.from_tensor_slices((
+        {"input_ids": ids_placeholder, "input_masks": masks_placeholder, "segment_ids": segments_placeholder},
+        labels_placeholder,
+    ))
+    if shuffle:
+        dataset = dataset.shuffle(4096)
+    # Batch before repeating, so that the last batch of a pass is partial instead of
+    # wrapping around to the first examples again
+    dataset = dataset.batch(batch_size).repeat()
+    # Labels stay int8 (one byte per class) and only the current batch is cast for the loss
+    dataset = dataset.map(lambda inputs, label: (inputs, tf.cast(label, tf.float32)))
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    iterator = dataset.make_initializable_iterator()
+    sess.run(iterator.initializer, feed_dict=dict(zip(placeholders, arrays)))
+    return iterator, int(math.ceil(len(input_ids) / batch_size))
+
+
+def dump_tfrecords(input_ids, input_masks, segment_ids, labels, shard_dir, n_shards=16):
+    """Write the features as `tf.train.Example`s, round-robin over `n_shards` TFRecord
+    files in `shard_dir`. As in `save_features`, the shards are written to a unique
+    temporary directory renamed once complete, so neither an interrupted nor a
+    concurrent run leaves partial shards behind.
+    """
+    int64_feature = lambda values: tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+    tmp_dir = _make_tmp_dir(shard_dir)
+    writers = [
+        tf.python_io.TFRecordWriter(str(tmp_dir / f"{i:05d}-of-{n_shards:05d}.tfrecord"))
+        for i in range(n_shards)
+    ]
+    for i in tqdm(range(len(input_ids)), desc=f"Writing {shard_dir.name} shards"):
+        example = tf.train.Example(features=tf.train.Features(feature={
+            "input_ids": int64_feature(input_ids[i]),
+            "input_masks": int64_feature(input_masks[i]),
+            "segment_ids": int64_feature(segment_ids[i]),
+            "labels": int64_feature(labels[i]),
+        }))
+        writers[i % n_shards].write(example.SerializeToString())
+    for writer in writers:
+        writer.close()
+    _publish_dir(tmp_dir, shard_dir)
+
+
+def make_tfrecord_dataset(shard_dir, num_examples, max_seq_length=MAX_SEQ_LENGTH, batch_size=BATCH_SIZE,
+                          shuffle=False):
+    """Same as `make_dataset`, streaming the shards written by `dump_tfrecords`."""
+    files = sorted(tf.gfile.Glob(str(shard_dir / "*.tfrecord")))
+    feature_spec = {
+        "input_ids": tf.FixedLenFeature([max_seq_length], tf.int64),
+        "input_masks": tf.FixedLenFeature([max_seq_length], tf.int64),
+        "segment_ids": tf.FixedLenFeature([max_seq_length], tf.int64),
+        "labels": tf.FixedLenFeature([NUM_CLASSES], tf.int64),
+    }
+
+    def parse(serialized):
+        # Parses the whole batch at once
+        parsed = tf.parse_example(serialized, feature_spec)
+        inputs = {
+            "input_ids": tf.cast(parsed["input_ids"], tf.int32),
+            "input_masks": tf.cast(parsed["input_masks"], tf.uint8),
+            "segment_ids": tf.cast(parsed["segment_ids"], tf.int32),
+        }
+        return inputs, tf.cast(parsed["labels"], tf.float32)
+
+    # Concrete reader count: on TF 1.x the parallel reads do not accept AUTOTUNE
+    dataset = tf.data.TFRecordDataset(files, num_parallel_reads=min(8, len(files)))
+    if shuffle:
+        dataset = dataset.shuffle(4096)
+    # Batch before repeating, as in `make_dataset`
+    dataset = dataset.batch(batch_size).repeat()
+    dataset = dataset.map(parse, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset, int(math.ceil(num_examples / batch_size))
+
+
+def quantize_model(model_path, features, num_samples=100):
+    """Post-training int8 quantization of the saved model with TFLite, calibrated on
+    the first `num_samples` examples of `features`. The result is written next to
+    the model and can be run with `tf.lite.Interpreter`.
+    The converter clears the Keras session and reloads the model in a new graph,
+    so the model built for training, and the session configured by `main`, can
+    no longer be used afterwards.
+    """
+    input_ids, input_masks, segment_ids = features[:3]
+
+    def representative_dataset():
+        for i in range(min(num_samples, len(input_ids))):
+            yield [input_ids[i:i + 1], input_masks[i:i + 1], segment_ids[i:i + 1]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model_file(
+        model_path, custom_objects={'BertLayer': BertLayer}
+    )
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+    tflite_path = f"{model_path}.tflite"
+    with open(tflite_path, "wb") as f:
+        f.write(converter.convert())
+    return tflite_path
+
+
+def features_cache_path(cache_dir, csv_file, text_column, label_column, bert_path, max_seq_length, fast_tokenizer,
+                        gpu_tokenizer):
+    """Cache directory for the features of `csv_file`, keyed on the csv path and mtime,
+    the columns, the tokenizer settings and NUM_CLASSES. The vocab itself is not
+    hashed: `bert_path` stands for it, so a hub module changing behind the same
+    url is not detected.
+    """
+    csv_file = Path(csv_file).resolve()
+    key = "|".join(map(str, [
+        csv_file, csv_file.stat().st_mtime, text_column, label_column, bert_path, max_seq_length, fast_tokenizer,
+        gpu_tokenizer, NUM_CLASSES
+    ]))
+    return Path(cache_dir) / hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _make_tmp_dir(target):
+    """Unique temporary directory next to `target`, to be published with `_publish_dir`."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    return Path(tempfile.mkdtemp(dir=target.parent, prefix=f"{target.name}."))
+
+
+def _publish_dir(tmp_dir, target):
+    """Rename the completed `tmp_dir` to `target`. If a concurrent run got there
+    first, its (identical) output is kept and `tmp_dir` is removed.
+    """
+    try:
+        tmp_dir.rename(target)
+    except OSError:
+        if not target.is_dir():
+            raise
+        shutil.rmtree(tmp_dir)
+
+
+def save_features(cache_path, train_features, test_features):
+    tmp_path = _make_tmp_dir(cache_path)
+    for split, features in (("train", train_features), ("test", test_features)):
+        for name, array in zip(FEATURE_NAMES, features):
+            np.save(tmp_path / f"{split}_{name}.npy", array)
+    _publish_dir(tmp_path, cache_path)
+
+
+def load_features(cache_path):
+    """Memory-mapped train and test features from the cache, or None if not cached.
+    The maps avoid reading the files into memory up front; `make_dataset` still
+    copies each array once into the session when it feeds its iterator.
+    """
+    if not cache_path.is_dir():
+        return None
+    return tuple(
+        tuple(np.load(cache_path / f"{split}_{name}.npy", mmap_mode="r") for name in FEATURE_NAMES)
+        for split in ("train", "test")
+    )
+
+
+def prepare_features(csv_file, text_column, label_column, bert_path, max_seq_length, fast_tokenizer, gpu_tokenizer,
+                     num_workers=None):
+    """Read, split, tokenize and convert the csv file to train and test features."""
 
     df = pd.read_csv(csv_file, sep="\t", header=0)
     df.columns = ['id','labels','misc','text']
@@ -281,21 +620,32 @@ def main(csv_file, text_column='text', label_column='labels', bert_path=BERT_PAT
     train_text = train_df[text_column].tolist()
     train_text = [" ".join(t.split()[0:max_seq_length]) for t in train_text]
     train_text = np.array(train_text, dtype=object)[:, np.newaxis]
-    train_df = one_to_many(train_df, label_column)
-    labels = get_values(train_df, label_column)
+    train_df, labels = one_to_many(train_df, label_column)
     train_label = train_df[labels].values
 
 
     test_text = test_df[text_column].tolist()
     test_text = [" ".join(t.split()[0:max_seq_length]) for t in test_text]
     test_text = np.array(test_text, dtype=object)[:, np.newaxis]
-    test_df = one_to_many(test_df, label_column)
-    labels = get_values(test_df, label_column)
+    test_df, labels = one_to_many(test_df, label_column)
     test_label = test_df[labels].values
 
 
     # Instantiate tokenizer
-    tokenizer = create_tokenizer_from_hub_module(bert_path)
+    vocab_file, do_lower_case = get_tokenization_info(bert_path)
+    pool = None
+    if gpu_tokenizer or fast_tokenizer:
+        tokenizer = create_tokenizer(
+            vocab_file, do_lower_case, fast_tokenizer=fast_tokenizer, gpu_tokenizer=gpu_tokenizer
+        )
+        to_features = functools.partial(
+            convert_examples_to_features_gpu if gpu_tokenizer else convert_examples_to_features_fast, tokenizer
+        )
+    else:
+        # One pool for both sets; its workers build their own tokenizer from the vocab
+        if num_workers != 0:
+            pool = create_tokenizer_pool(vocab_file, do_lower_case, num_workers)
+        to_features = functools.partial(convert_examples_to_features, vocab_file, do_lower_case, pool=pool)
 
     # Convert data to InputExample format
     train_examples = convert_text_to_examples(train_text, train_label)
@@ -304,47 +654,101 @@ def main(csv_file, text_column='text', label_column='labels', bert_path=BERT_PAT
 
 
     # Convert to features
-    (
-        train_input_ids,
-        train_input_masks,
-        train_segment_ids,
-        train_label,
-    ) = convert_examples_to_features(
-        tokenizer, train_examples, max_seq_length=max_seq_length
-    )
-    (
-        test_input_ids,
-        test_input_masks,
-        test_segment_ids,
-        test_label,
-    ) = convert_examples_to_features(
-        tokenizer, test_examples, max_seq_length=max_seq_length
+    try:
+        train_features = to_features(train_examples, max_seq_length=max_seq_length)
+        test_features = to_features(test_examples, max_seq_length=max_seq_length)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return train_features, test_features
+
+
+@plac.annotations(
+    csv_file=("Path to input csv file", "positional", None, Path),
+    text_column=("Name of text column","option","text_column",str),
+    label_column=("Name of label column", "option", "label_column", str),
+    bert_path=("Bert url", "option", "bert_path", str),
+    fast_tokenizer=("Tokenize with the Rust tokenizers library", "flag", "fast_tokenizer"),
+    gpu_tokenizer=("Tokenize on the GPU with the RAPIDS cudf subword tokenizer", "flag", "gpu_tokenizer"),
+    mixed_precision=("Train with float16 compute (GPU, tensorflow>=1.14)", "flag", "mixed_precision"),
+    cache_dir=("Directory where converted features are cached", "option", "cache_dir", str),
+    reload_model=("Reload the saved model after training", "flag", "reload_model"),
+    quantize=("Also save an int8 quantized TFLite model (tensorflow>=1.14)", "flag", "quantize"),
+    tfrecords=("Stream features from TFRecord shards in the cache directory", "flag", "tfrecords"),
+    xla=("Compile the graph with XLA JIT", "flag", "xla"),
+    num_workers=("Tokenizer processes (default: one per core, 0: tokenize in the main process)", "option",
+                 "num_workers", int),
+)
+def main(csv_file, text_column='text', label_column='labels', bert_path=BERT_PATH, max_seq_length=MAX_SEQ_LENGTH, model_path=MODEL_PATH, fast_tokenizer=False, gpu_tokenizer=False, mixed_precision=False, cache_dir=FEATURES_CACHE_DIR, reload_model=False, quantize=False, tfrecords=False, xla=False, num_workers=None):
+
+    if fast_tokenizer and gpu_tokenizer:
+        raise ValueError("--fast_tokenizer and --gpu_tokenizer cannot be used together")
+    if quantize:
+        # Checked up front rather than failing after training
+        _require_tflite()
+
+    sess = create_session(xla=xla, mixed_precision=mixed_precision)
+    K.set_session(sess)
+
+    cache_path = features_cache_path(
+        cache_dir, csv_file, text_column, label_column, bert_path, max_seq_length, fast_tokenizer, gpu_tokenizer
     )
+    cached = load_features(cache_path)
+    if cached is not None:
+        logger.info(f"Loading features from {cache_path}")
+        train_features, test_features = cached
+    else:
+        train_features, test_features = prepare_features(
+            csv_file, text_column, label_column, bert_path, max_seq_length, fast_tokenizer, gpu_tokenizer,
+            num_workers=num_workers
+        )
+        save_features(cache_path, train_features, test_features)
 
     logger.info("Building model")
-    model = build_model(max_seq_length)
+    model = build_model(max_seq_length, mixed_precision=mixed_precision)
 
     # Instantiate variables
     initialize_vars(sess)
 
+    if tfrecords:
+        datasets = []
+        for split, features in (("train", train_features), ("test", test_features)):
+            shard_dir = cache_path / f"{split}_tfrecords"
+            if not shard_dir.is_dir():
+                dump_tfrecords(*features, shard_dir)
+            datasets.append(make_tfrecord_dataset(
+                shard_dir, len(features[0]), max_seq_length=max_seq_length, shuffle=split == "train"
+            ))
+        (train_ds, train_steps), (test_ds, test_steps) = datasets
+    else:
+        train_ds, train_steps = make_dataset(sess, *train_features, shuffle=True)
+        test_ds, test_steps = make_dataset(sess, *test_features)
+
     logger.info("Training")
     model.fit(
-        [train_input_ids, train_input_masks, train_segment_ids],
-        train_label,
-        validation_data=(
-            [test_input_ids, test_input_masks, test_segment_ids],
-            test_label,
-        ),
+        train_ds,
+        steps_per_epoch=train_steps,
+        validation_data=test_ds,
+        validation_steps=test_steps,
         epochs=1,
-        batch_size=64,
         verbose=2
     )
 
     model.save(model_path)
 
+    if reload_model:
+        model = tf.keras.models.load_model(model_path, custom_objects={'BertLayer': BertLayer})
+        model.summary()
+
+    # Last, as the conversion clears the Keras session
+    if quantize:
+        logger.info(f"Quantized model saved to {quantize_model(model_path, train_features)}")
+
 
 if __name__ == "__main__":
     plac.call(main)
-    model = tf.keras.models.load_model(MODEL_PATH, custom_objects={'BertLayer': BertLayer})
-    model.summary()
 
@@ -1,20 +1,16 @@
 from pandas import DataFrame
 import pandas as pd
+import numpy as np
 
 pd.set_option('mode.chained_assignment', None)
 
 
 def one_to_many(df : DataFrame, column_name):
-    columns = sorted(list(set(df[column_name].tolist())))
-    for column in columns:
-        df[column] = 0
-        df[column] = df[column].astype(int)
-    for i, row in df.iterrows():
-        for column in columns:
-            if column == row[column_name]:
-                df.loc[i,column] = 1
-    return df
+    """Adds one int8 column per value of `column_name`; returns the frame and the sorted values."""
+    columns = get_values(df, column_name)
+    one_hot = pd.get_dummies(df[column_name], dtype=np.int8).reindex(columns=columns, fill_value=0)
+    return df.join(one_hot), columns
 
 
 def get_values(df: DataFrame, column_name):
-    return sorted(list(set(df[column_name].tolist())))
\ No newline at end of file
+    return np.sort(df[column_name].unique()).tolist()
\ No newline at end of file